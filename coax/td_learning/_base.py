@@ -1,18 +1,29 @@
+import os
+import sys
+import warnings
 from abc import ABC, abstractmethod
+from functools import partial, wraps
+from typing import Any, NamedTuple
 
 import jax
 import jax.numpy as jnp
+import numpy as onp
 import haiku as hk
 import optax
 import chex
 
 from .._base.mixins import RandomStateMixin
-from ..utils import get_grads_diagnostics, is_policy, is_stochastic, is_qfunction, is_vfunction, jit
+from ..utils import (
+    get_grads_diagnostics, is_policy, is_stochastic, is_qfunction, is_vfunction, jit, pmap)
+from ..utils import _jit as _jit_module
 from ..value_losses import huber, quantile_huber
 from ..regularizers import Regularizer
 from ..proba_dists import DiscretizedIntervalDist, EmpiricalQuantileDist
 
 
+_JAX_DIR = os.path.dirname(jax.__file__)
+
+
 __all__ = (
     'BaseTDLearningV',
     'BaseTDLearningQ',
@@ -20,6 +31,108 @@ __all__ = (
 )
 
 
+class _LossAux(NamedTuple):
+    td_error: jnp.ndarray
+    state_new: Any
+    metrics: dict
+
+
+def _warn_on_retrace(func, name, get_threshold_and_hint):
+    # every trace of a jitted function runs the python body, so we can count the distinct shapes
+    # of the last positional argument (the transition batch or the grads) that triggered a
+    # (re)compilation; the threshold and hint are looked up when a new shape comes in, because
+    # they may depend on settings that change after construction, e.g. pad_batches
+    shapes_seen = set()
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        shapes = tuple(onp.shape(x) for x in jax.tree_util.tree_leaves(args[-1]))
+        if shapes not in shapes_seen:
+            shapes_seen.add(shapes)
+            threshold, hint = get_threshold_and_hint()
+            if len(shapes_seen) > threshold:
+                warnings.warn(
+                    f"{name} was recompiled for {len(shapes_seen)} different input shapes, the "
+                    f"latest being: {sorted(set(shapes))}; {hint}",
+                    stacklevel=_caller_stacklevel())
+        return func(*args, **kwargs)
+
+    return wrapped
+
+
+def _caller_stacklevel():
+    # the stacklevel (relative to our caller) of the first frame outside of jax and the coax
+    # internals that dispatch to the jitted functions, i.e. the user code that called e.g. update()
+    internal_files = (__file__, _jit_module.__file__)
+    frame, stacklevel = sys._getframe(2), 2
+    while frame is not None and (
+            frame.f_code.co_filename in internal_files
+            or frame.f_code.co_filename.startswith(_JAX_DIR)):
+        frame, stacklevel = frame.f_back, stacklevel + 1
+    return stacklevel
+
+
+def _grads_have_nan_func(grads):
+    # a float rather than a bool, so that averaging this metric gives the fraction of nan steps
+    grads_have_nan = jnp.stack([jnp.any(jnp.isnan(g)) for g in jax.tree_util.tree_leaves(grads)])
+    return jnp.any(grads_have_nan).astype(jnp.float32)
+
+
+def _debug_nan_enabled():
+    # an unset or empty COAX_DEBUG_NAN, or one that's set to e.g. '0' or 'false', means disabled
+    value = os.environ.get('COAX_DEBUG_NAN', '').strip().lower()
+    return value not in ('', '0', 'false', 'no', 'off')
+
+
+def _pad_batch(transition_batch, pow2=False, multiple=1):
+    # if pow2=True, round the batch size up to a power of two (at least 8), so that we get at most
+    # log2(n) distinct shapes; then round it up to a multiple of the given number; padded rows
+    # repeat the last transition; also returns the mask of unpadded rows, or None if not padded
+    n = transition_batch.batch_size
+    n_padded = max(8, 1 << (n - 1).bit_length()) if pow2 else n
+    n_padded = -(-n_padded // multiple) * multiple
+    if n_padded == n:
+        return transition_batch, None
+
+    def pad(x):
+        # pad device-resident leaves on the device, rather than copying them to the host and back
+        xp = jnp if isinstance(x, jax.Array) else onp
+        x = xp.asarray(x)
+        return xp.concatenate((x, xp.repeat(x[-1:], n_padded - n, axis=0)))
+
+    return jax.tree_util.tree_map(pad, transition_batch), onp.arange(n_padded) < n
+
+
+def _mask_and_frac_valid(mask):
+    # the fraction of unpadded rows rescales the batch means; it's floored at 1/n so that a batch
+    # that's all padding (e.g. a micro-batch or a shard) yields zero loss and grads, not nan's
+    if mask is None:
+        return 1., 1.
+    return mask, jnp.maximum(jnp.mean(mask), 1. / mask.shape[0])
+
+
+def _metrics_mean(*xs):
+    # metrics are diagnostics only: read them in bfloat16, but accumulate in float32; the batch
+    # means of all inputs are computed in a single reduction
+    return jnp.mean(jnp.stack(xs).astype(jnp.bfloat16), axis=1, dtype=jnp.float32)
+
+
+def _weigh_metrics(metrics, w):
+    # weigh the metrics of a shard or micro-batch by its share w of the unpadded rows; the
+    # td_error_targ metric is a batch mean of the grads of a batch-mean loss, i.e. it scales with
+    # 1 / batch_size**2 rather than 1 / batch_size, so it's weighted by w**2 instead
+    return {k: (w ** 2 if k.endswith('/td_error_targ') else w) * v for k, v in metrics.items()}
+
+
+def _same_objects(a, b):
+    # containers are compared entry by entry, e.g. Regularizer.hyperparams is a new dict each time
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(a[k] is b[k] for k in a)
+    return a is b
+
+
 class BaseTDLearning(ABC, RandomStateMixin):
     def __init__(self, f, f_targ=None, optimizer=None, loss_function=None, policy_regularizer=None):
 
@@ -32,6 +145,15 @@ class BaseTDLearning(ABC, RandomStateMixin):
                 f"policy_regularizer must be a Regularizer, got: {type(policy_regularizer)}")
         self.policy_regularizer = policy_regularizer
 
+        # pad variable-size batches to a few fixed shapes, to avoid recompiling for every new size
+        self.pad_batches = False
+
+        # split update() batches across all local devices
+        self.replicated = False
+
+        # cache for the target_params and target_function_state properties
+        self._immutable_dict_cache = {}
+
         # optimizer
         self._optimizer = optax.adam(1e-3) if optimizer is None else optimizer
         self._optimizer_state = self.optimizer.init(self._f.params)
@@ -41,12 +163,106 @@ class BaseTDLearning(ABC, RandomStateMixin):
             new_params = optax.apply_updates(params, updates)
             return new_opt_state, new_params
 
-        self._apply_grads_func = jit(apply_grads_func, static_argnums=0)
+        def update_func(
+                opt, opt_state, params, target_params, state, target_state, rng, transition_batch,
+                mask=None, axis_name=None):
+
+            if axis_name is not None:
+                rng = jax.random.fold_in(rng, jax.lax.axis_index(axis_name))
+
+            # the subclass-specific grads_and_metrics_func is inlined into this trace; we call the
+            # un-jitted version, so that shards don't count as retraces of grads_and_metrics()
+            grads, state_new, metrics, td_error = self._grads_and_metrics_func_pure(
+                params, target_params, state, target_state, rng, transition_batch, mask=mask)
+
+            if axis_name is not None:
+                # average over devices, weighted by the number of unpadded rows on each device
+                w = 1. if mask is None else jnp.mean(mask)
+                w /= jax.lax.psum(w, axis_name)
+                grads, metrics = jax.lax.psum(
+                    (jax.tree_util.tree_map(lambda g: w * g, grads), _weigh_metrics(metrics, w)),
+                    axis_name)
+
+                # the grads diagnostics should describe the averaged grads that are applied
+                metrics.update(get_grads_diagnostics(grads, f'{self.__class__.__name__}/grads_'))
+                state_new = jax.tree_util.tree_map(
+                    lambda x: jax.lax.pmean(x, axis_name)
+                    if jnp.issubdtype(x.dtype, jnp.floating) else x, state_new)
+
+            metrics[f'{self.__class__.__name__}/grads_has_nan'] = _grads_have_nan_func(grads)
+            opt_state_new, params_new = apply_grads_func(opt, opt_state, params, grads)
+            return params_new, state_new, opt_state_new, metrics, td_error
+
+        def accumulated_update_func(
+                opt, opt_state, params, target_params, state, target_state, rng,
+                transition_batches, mask=None):
+
+            def accumulate(carry, xs):
+                grads_sum, state, rng = carry
+                transition_batch, mask = xs
+                rng, rng_step = jax.random.split(rng)
+                grads, state_new, metrics, td_error = self._grads_and_metrics_func_pure(
+                    params, target_params, state, target_state, rng_step, transition_batch,
+                    mask=mask)
+                w = 1. if mask is None else jnp.mean(mask)  # weigh by the number of unpadded rows
+                grads_sum = jax.tree_util.tree_map(lambda a, g: a + w * g, grads_sum, grads)
+                return (grads_sum, state_new, rng), (w, metrics, td_error)
+
+            # the leading axis of transition_batches enumerates the micro-batches
+            grads_sum = jax.tree_util.tree_map(jnp.zeros_like, params)
+            (grads_sum, state_new, _), (w, metrics, td_error) = jax.lax.scan(
+                accumulate, (grads_sum, state, rng), (transition_batches, mask))
+            grads = jax.tree_util.tree_map(lambda g: g / jnp.sum(w), grads_sum)
+            metrics = jax.tree_util.tree_map(jnp.sum, _weigh_metrics(metrics, w / jnp.sum(w)))
+
+            # the grads diagnostics should describe the accumulated grads that are applied
+            metrics.update(get_grads_diagnostics(grads, f'{self.__class__.__name__}/grads_'))
+
+            metrics[f'{self.__class__.__name__}/grads_has_nan'] = _grads_have_nan_func(grads)
+            opt_state_new, params_new = apply_grads_func(opt, opt_state, params, grads)
+            return params_new, state_new, opt_state_new, metrics, td_error
+
+        name = self.__class__.__name__
+        self._apply_grads_func = jit(
+            _warn_on_retrace(
+                apply_grads_func, f'{name}.apply_grads',
+                lambda: (3, "the grads are expected to have the same shapes as the params")),
+            static_argnums=0)
+        # the optimizer state is only ever held by this object, so we let xla update it in-place
+        self._update_func = jit(
+            _warn_on_retrace(update_func, f'{name}.update', self._retrace_threshold_and_hint),
+            static_argnums=0, donate_argnums=1)
+        self._update_func_replicated = pmap(
+            _warn_on_retrace(
+                partial(update_func, axis_name='i'), f'{name}.update',
+                self._retrace_threshold_and_hint),
+            axis_name='i',
+            in_axes=(None,) * 7 + (0,), out_axes=(None,) * 4 + (0,),  # only the batch is split
+            static_broadcasted_argnums=0)
+        self._accumulated_update_func = jit(
+            _warn_on_retrace(
+                accumulated_update_func, f'{name}.update', self._retrace_threshold_and_hint),
+            static_argnums=0, donate_argnums=1)
 
     @abstractmethod
     def target_func(self, target_params, target_state, rng, transition_batch):
         pass
 
+    def _policy_regularizer_func(self, target_params, target_state, rng, transition_batch):
+        # the regularization term (and its metrics) by which the TD-target is shifted
+        if self.policy_regularizer is None:
+            return 0., {}
+        regularizer, metrics = self.policy_regularizer.batch_eval(
+            target_params['reg'], target_params['reg_hparams'], target_state['reg'], rng,
+            transition_batch)
+        return regularizer, {f'{self.__class__.__name__}/{k}': v for k, v in metrics.items()}
+
+    def _retrace_threshold_and_hint(self):
+        # padded batch sizes are powers of two, so we expect about log2(max batch size) shapes
+        if self.pad_batches:
+            return 16, "the batch size is already padded, so something else about the shapes varies"
+        return 3, "consider setting pad_batches=True if the batch size varies"
+
     @property
     @abstractmethod
     def target_params(self):
@@ -57,11 +273,26 @@ class BaseTDLearning(ABC, RandomStateMixin):
     def target_function_state(self):
         pass
 
-    def update(self, transition_batch, return_td_error=False):
+    def update(self, transition_batch, return_td_error=False, accumulation_steps=1):
         r"""
 
         Update the model parameters (weights) of the underlying function approximator.
 
+        The check for nan's in the gradients is reported as a metric, so that it doesn't force the
+        host to wait for the device. Set the environment variable :code:`COAX_DEBUG_NAN=1` to raise
+        an error instead.
+
+        If the batch size varies from one call to the next, e.g. with prioritized replay, set
+        :code:`pad_batches=True` to avoid JIT recompilation for every new batch size. The batch is
+        then padded up to the next power of two with transitions that are masked out. These padded
+        rows don't contribute to the loss, but they are seen by the forward pass, which matters if
+        the function has a state that is updated in the forward pass, e.g. batch normalization.
+
+        On a machine with multiple devices, set :code:`replicated=True` to split the batch across
+        all local devices (padding it where needed). The gradients are then averaged over devices
+        before they're applied, so the parameters stay the same on all devices. This only affects
+        :func:`update`, not :func:`grads_and_metrics` or :func:`td_error`.
+
         Parameters
         ----------
         transition_batch : TransitionBatch
@@ -72,6 +303,13 @@ class BaseTDLearning(ABC, RandomStateMixin):
 
             Whether to return the TD-errors.
 
+        accumulation_steps : positive int, optional
+
+            If larger than 1, the batch is split into this many equal-size micro-batches. The
+            gradients of these micro-batches are accumulated and then applied in a single
+            optimizer step. This caps the memory that a large batch needs in the forward and
+            backward passes.
+
         Returns
         -------
         metrics : dict of scalar ndarrays
@@ -84,10 +322,30 @@ class BaseTDLearning(ABC, RandomStateMixin):
             we set :code:`return_td_error=True`.
 
         """
-        grads, function_state, metrics, td_error = self.grads_and_metrics(transition_batch)
-        if any(jnp.any(jnp.isnan(g)) for g in jax.tree_util.tree_leaves(grads)):
-            raise RuntimeError(f"found nan's in grads: {grads}")
-        self.apply_grads(grads, function_state)
+        batch_size = transition_batch.batch_size
+        update_func, transition_batch, mask = \
+            self._update_func_and_batch(transition_batch, accumulation_steps)
+        debug_nan = _debug_nan_enabled()
+        optimizer_state = self.optimizer_state
+        if debug_nan:
+            # donate a copy, so that nothing has been changed yet if we need to raise below
+            optimizer_state = jax.tree_util.tree_map(jnp.copy, optimizer_state)
+        try:
+            params, function_state, optimizer_state, metrics, td_error = update_func(
+                self.optimizer, optimizer_state, self._f.params, self.target_params,
+                self._f.function_state, self.target_function_state, self._f.rng, transition_batch,
+                mask=mask)
+        except ValueError as e:
+            if 'donated' not in str(e):
+                raise
+            raise ValueError(
+                "the optimizer_state is donated to update(), which means that a reference to an "
+                "old optimizer_state can't be set or used after the next call to update()") from e
+        td_error = td_error.reshape(-1)[:batch_size]
+        if debug_nan and metrics[f'{self.__class__.__name__}/grads_has_nan']:
+            raise RuntimeError(f"found nan's in grads, see metrics: {metrics}")
+        self._f.function_state = function_state
+        self.optimizer_state, self._f.params = optimizer_state, params
         return (metrics, td_error) if return_td_error else metrics
 
     def apply_grads(self, grads, function_state):
@@ -97,7 +355,8 @@ class BaseTDLearning(ABC, RandomStateMixin):
         pre-computed gradients.
 
         This method is useful in situations in which computation of the gradients is deligated to a
-        separate (remote) process.
+        separate (remote) process. Note that :func:`update` doesn't go through this method; it
+        computes and applies the gradients in a single JIT-compiled step.
 
         Parameters
         ----------
@@ -111,6 +370,9 @@ class BaseTDLearning(ABC, RandomStateMixin):
             <coax.Q.function_state>` and :func:`haiku.transform_with_state` for more details.
 
         """
+        # the grads may have been computed elsewhere, e.g. in a separate process, so we stage them
+        # on the device in one go; this way the function_state isn't kept as host arrays either
+        grads, function_state = jax.device_put((grads, function_state))
         self._f.function_state = function_state
         self.optimizer_state, self._f.params = \
             self._apply_grads_func(self.optimizer, self.optimizer_state, self._f.params, grads)
@@ -146,9 +408,12 @@ class BaseTDLearning(ABC, RandomStateMixin):
             The non-aggregated TD-errors, :code:`shape == (batch_size,)`.
 
         """
-        return self._grads_and_metrics_func(
+        batch_size = transition_batch.batch_size
+        transition_batch, mask = self._prepare_batch(transition_batch)
+        grads, function_state, metrics, td_error = self._grads_and_metrics_func(
             self._f.params, self.target_params, self._f.function_state, self.target_function_state,
-            self._f.rng, transition_batch)
+            self._f.rng, transition_batch, mask=mask)
+        return grads, function_state, metrics, td_error[:batch_size]
 
     def td_error(self, transition_batch):
         r"""
@@ -163,6 +428,11 @@ class BaseTDLearning(ABC, RandomStateMixin):
         Note that this reduces to the ordinary definition :math:`\text{td_error}=y-\hat{y}` when we
         use the :func:`coax.value_losses.mse` loss funtion.
 
+        If you're going to update on the same batch anyway, use :code:`update(transition_batch,
+        return_td_error=True)` instead. This computes the TD-errors in the same forward pass, which
+        means that the batch (including the observation and action preprocessing) is only
+        processed once.
+
         Parameters
         ----------
         transition_batch : TransitionBatch
@@ -176,9 +446,93 @@ class BaseTDLearning(ABC, RandomStateMixin):
             A batch of TD-errors.
 
         """
-        return self._td_error_func(
+        batch_size = transition_batch.batch_size
+        transition_batch, mask = self._prepare_batch(transition_batch)
+        td_error = self._td_error_func(
             self._f.params, self.target_params, self._f.function_state, self.target_function_state,
-            self._f.rng, transition_batch)
+            self._f.rng, transition_batch, mask=mask)
+        return td_error[:batch_size]
+
+    def precompile(self, transition_batch, accumulation_steps=1):
+        r"""
+
+        Compile the jitted functions ahead of time, so that the first calls to :func:`update`,
+        :func:`apply_grads`, :func:`grads_and_metrics` and :func:`td_error` don't have to wait for
+        the JIT compiler.
+
+        This doesn't update anything; only the shapes and dtypes of the transition batch matter, so
+        it's fine to pass e.g. the first batch that comes out of the replay buffer. Note that the
+        compiled functions are specific to the batch size (unless :code:`pad_batches=True`) and to
+        the :code:`replicated` setting, so set these before calling this method.
+
+        To skip compilation altogether in subsequent runs, you can enable JAX's persistent
+        compilation cache, e.g. :code:`jax.config.update('jax_compilation_cache_dir', '/tmp/jax')`.
+
+        Parameters
+        ----------
+        transition_batch : TransitionBatch
+
+            An example batch of transitions.
+
+        accumulation_steps : positive int, optional
+
+            The number of micro-batches that will be passed to :func:`update`.
+
+        """
+        # don't draw from self._f.rng, so that precompiling doesn't alter the random stream
+        rng = jax.random.PRNGKey(0)
+        update_func, batch, mask = \
+            self._update_func_and_batch(transition_batch, accumulation_steps)
+        update_func.lower(
+            self.optimizer, self.optimizer_state, self._f.params, self.target_params,
+            self._f.function_state, self.target_function_state, rng, batch, mask=mask).compile()
+        self._apply_grads_func.lower(
+            self.optimizer, self.optimizer_state, self._f.params, self._f.params).compile()
+        batch, mask = self._prepare_batch(transition_batch)
+        for func in (self._grads_and_metrics_func, self._td_error_func):
+            func.lower(
+                self._f.params, self.target_params, self._f.function_state,
+                self.target_function_state, rng, batch, mask=mask).compile()
+
+    def _update_func_and_batch(self, transition_batch, accumulation_steps):
+        # pick the variant of the update function and shape the batch (and padding mask) to match
+        if accumulation_steps > 1:
+            if self.replicated and jax.local_device_count() > 1:
+                raise ValueError(
+                    "accumulation_steps > 1 isn't supported in combination with replicated=True")
+            if accumulation_steps > transition_batch.batch_size:
+                raise ValueError(
+                    f"accumulation_steps={accumulation_steps} exceeds the batch size: "
+                    f"{transition_batch.batch_size}")
+            return (self._accumulated_update_func,
+                    *jax.device_put(self._shard_batch(transition_batch, accumulation_steps)))
+        if self.replicated and jax.local_device_count() > 1:
+            return (self._update_func_replicated,
+                    *self._shard_batch(transition_batch, jax.local_device_count()))
+        return (self._update_func, *self._prepare_batch(transition_batch))
+
+    def _prepare_batch(self, transition_batch):
+        # stage the (host) arrays on the default device in one go, rather than leaving it to the
+        # jitted function to copy them leaf by leaf; this is a no-op for device-resident batches
+        return jax.device_put(_pad_batch(transition_batch, pow2=self.pad_batches))
+
+    def _shard_batch(self, transition_batch, num_shards):
+        # split the batch into equal-size shards (for devices or micro-batches) along a new leading
+        # axis, i.e. the leaves get shape: [num_shards, shard_size, ...]
+        transition_batch, mask = \
+            _pad_batch(transition_batch, pow2=self.pad_batches, multiple=num_shards)
+        return jax.tree_util.tree_map(
+            lambda x: x.reshape((num_shards, -1, *x.shape[1:])), (transition_batch, mask))
+
+    def _to_immutable_dict_cached(self, name, mapping):
+        # reuse the immutable dict for as long as it's made up of the same objects
+        cached = self._immutable_dict_cache.get(name)
+        if cached is not None and cached[0].keys() == mapping.keys() and all(
+                _same_objects(cached[0][k], v) for k, v in mapping.items()):
+            return cached[1]
+        immutable_dict = hk.data_structures.to_immutable_dict(mapping)
+        self._immutable_dict_cache[name] = mapping, immutable_dict
+        return immutable_dict
 
     @property
     def optimizer(self):
@@ -220,12 +574,18 @@ class BaseTDLearningV(BaseTDLearning):
             loss_function=loss_function,
             policy_regularizer=policy_regularizer)
 
-        def loss_func(params, target_params, state, target_state, rng, transition_batch):
+        # resolve these once, so that the traced functions don't look them up on self
+        loss_function = self.loss_function
+        target_func = self.target_func
+        policy_regularizer_func = self._policy_regularizer_func
+        dLoss_dV = jax.grad(loss_function, argnums=1)
+
+        def loss_func(params, target_params, state, target_state, rng, transition_batch, mask=None):
             """
 
             In this function we tie together all the pieces, which is why it's a bit long.
 
-            The main structure to watch for is calls to self.target_func(...), which is defined
+            The main structure to watch for is calls to target_func(...), which is defined
             downstream. All other code is essentially boilerplate to tie this target to the
             predictions, i.e. to construct a feedback signal for training.
 
@@ -235,91 +595,92 @@ class BaseTDLearningV(BaseTDLearning):
             -kris
 
             """
-            rngs = hk.PRNGSequence(rng)
-            S = self.v.observation_preprocessor(next(rngs), transition_batch.S)
+            rngs = jax.random.split(rng, 8)
+            S = self.v.observation_preprocessor(rngs[0], transition_batch.S)
             W = jnp.clip(transition_batch.W, 0.1, 10.)  # clip importance weights to reduce variance
-
-            metrics = {}
+            mask, frac_valid = _mask_and_frac_valid(mask)  # the mask is None if there's no padding
+            W *= mask
 
             # regularization term
-            if self.policy_regularizer is None:
-                regularizer = 0.
-            else:
-                regularizer, regularizer_metrics = self.policy_regularizer.batch_eval(
-                    target_params['reg'], target_params['reg_hparams'], target_state['reg'],
-                    next(rngs), transition_batch)
-                metrics.update({f'{self.__class__.__name__}/{k}': v for k,
-                               v in regularizer_metrics.items()})
+            regularizer, metrics = \
+                policy_regularizer_func(target_params, target_state, rngs[1], transition_batch)
 
             if is_stochastic(self.v):
-                dist_params, state_new = self.v.function(params, state, next(rngs), S, True)
+                dist_params, state_new = self.v.function(params, state, rngs[2], S, True)
                 dist_params_target = \
-                    self.target_func(target_params, target_state, rng, transition_batch)
+                    target_func(target_params, target_state, rngs[3], transition_batch)
 
                 if self.policy_regularizer is not None:
                     dist_params_target = self.v.proba_dist.affine_transform(
                         dist_params_target, 1., -regularizer, self.v.value_transform)
 
                 if isinstance(self.v.proba_dist, DiscretizedIntervalDist):
-                    loss = jnp.mean(self.v.proba_dist.cross_entropy(dist_params_target,
-                                                                    dist_params))
+                    loss = jnp.mean(mask * self.v.proba_dist.cross_entropy(
+                        dist_params_target, dist_params))
                 elif isinstance(self.v.proba_dist, EmpiricalQuantileDist):
                     loss = quantile_huber(dist_params_target['values'],
                                           dist_params['values'],
                                           dist_params['quantile_fractions'], W)
+                loss /= frac_valid
 
                 # the rest here is only needed for metrics dict
                 V = self.v.proba_dist.mean(dist_params)
-                V = self.v.proba_dist.postprocess_variate(next(rngs), V, batch_mode=True)
+                V = self.v.proba_dist.postprocess_variate(rngs[4], V, batch_mode=True)
                 G = self.v.proba_dist.mean(dist_params_target)
-                G = self.v.proba_dist.postprocess_variate(next(rngs), G, batch_mode=True)
+                G = self.v.proba_dist.postprocess_variate(rngs[5], G, batch_mode=True)
                 dist_params_v_targ, _ = self.v.function(
-                    target_params['v_targ'], target_state['v_targ'], next(rngs), S, False)
+                    target_params['v_targ'], target_state['v_targ'], rngs[6], S, False)
                 V_targ = self.v.proba_dist.mean(dist_params_v_targ)
-                V_targ = self.v.proba_dist.postprocess_variate(next(rngs), V_targ, batch_mode=True)
+                V_targ = self.v.proba_dist.postprocess_variate(rngs[7], V_targ, batch_mode=True)
 
             else:
-                V, state_new = self.v.function(params, state, next(rngs), S, True)
-                G = self.target_func(target_params, target_state, next(rngs), transition_batch)
+                V, state_new = self.v.function(params, state, rngs[2], S, True)
+                G = target_func(target_params, target_state, rngs[3], transition_batch)
                 # flip sign (typical example: regularizer = -beta * entropy)
                 G -= regularizer
-                loss = self.loss_function(G, V, W)
+                loss = loss_function(G, V, W) / frac_valid
 
                 # only needed for metrics dict
                 V_targ, _ = self.v.function(
-                    target_params['v_targ'], target_state['v_targ'], next(rngs), S, False)
+                    target_params['v_targ'], target_state['v_targ'], rngs[6], S, False)
 
             chex.assert_equal_shape([G, V, V_targ, W])
             chex.assert_rank([G, V, V_targ, W], 1)
-            dLoss_dV = jax.grad(self.loss_function, argnums=1)
             td_error = -V.shape[0] * dLoss_dV(G, V)  # e.g. (G - V) if loss function is MSE
             chex.assert_equal_shape([td_error, W])
+            td_error_mean, td_error_targ_mean = \
+                _metrics_mean(W * td_error, -dLoss_dV(V, V_targ, W))
             metrics.update({
                 f'{self.__class__.__name__}/loss': loss,
-                f'{self.__class__.__name__}/td_error': jnp.mean(W * td_error),
-                f'{self.__class__.__name__}/td_error_targ': jnp.mean(-dLoss_dV(V, V_targ, W)),
+                f'{self.__class__.__name__}/td_error': td_error_mean / frac_valid,
+                f'{self.__class__.__name__}/td_error_targ': td_error_targ_mean / frac_valid ** 2,
             })
-            return loss, (td_error, state_new, metrics)
+            return loss, _LossAux(td_error, state_new, metrics)
 
         def grads_and_metrics_func(
-                params, target_params, state, target_state, rng, transition_batch):
+                params, target_params, state, target_state, rng, transition_batch, mask=None):
 
-            rngs = hk.PRNGSequence(rng)
-            grads, (td_error, state_new, metrics) = jax.grad(loss_func, has_aux=True)(
-                params, target_params, state, target_state, next(rngs), transition_batch)
+            grads, aux = jax.grad(loss_func, has_aux=True)(
+                params, target_params, state, target_state, rng, transition_batch, mask)
+            td_error, state_new, metrics = aux
 
             # add some diagnostics about the gradients
             metrics.update(get_grads_diagnostics(grads, f'{self.__class__.__name__}/grads_'))
 
             return grads, state_new, metrics, td_error
 
-        def td_error_func(params, target_params, state, target_state, rng, transition_batch):
-            loss, (td_error, state_new, metrics) =\
-                loss_func(params, target_params, state, target_state, rng, transition_batch)
-            return td_error
+        def td_error_func(
+                params, target_params, state, target_state, rng, transition_batch, mask=None):
+            _, aux = loss_func(
+                params, target_params, state, target_state, rng, transition_batch, mask)
+            return aux.td_error
 
-        self._grads_and_metrics_func = jit(grads_and_metrics_func)
-        self._td_error_func = jit(td_error_func)
+        name = self.__class__.__name__
+        self._grads_and_metrics_func_pure = grads_and_metrics_func  # inlined by the update funcs
+        self._grads_and_metrics_func = jit(_warn_on_retrace(
+            grads_and_metrics_func, f'{name}.grads_and_metrics', self._retrace_threshold_and_hint))
+        self._td_error_func = jit(_warn_on_retrace(
+            td_error_func, f'{name}.td_error', self._retrace_threshold_and_hint))
 
     @property
     def v(self):
@@ -331,7 +692,7 @@ class BaseTDLearningV(BaseTDLearning):
 
     @property
     def target_params(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_params', {
             'v': self.v.params,
             'v_targ': self.v_targ.params,
             'reg': getattr(getattr(self.policy_regularizer, 'f', None), 'params', None),
@@ -339,7 +700,7 @@ class BaseTDLearningV(BaseTDLearning):
 
     @property
     def target_function_state(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_function_state', {
             'v': self.v.function_state,
             'v_targ': self.v_targ.function_state,
             'reg': getattr(getattr(self.policy_regularizer, 'f', None), 'function_state', None)})
@@ -375,12 +736,17 @@ class BaseTDLearningQ(BaseTDLearning):
             loss_function=loss_function,
             policy_regularizer=policy_regularizer)
 
-        def loss_func(params, target_params, state, target_state, rng, transition_batch):
+        loss_function = self.loss_function
+        target_func = self.target_func
+        policy_regularizer_func = self._policy_regularizer_func
+        dLoss_dQ = jax.grad(loss_function, argnums=1)
+
+        def loss_func(params, target_params, state, target_state, rng, transition_batch, mask=None):
             """
 
             In this function we tie together all the pieces, which is why it's a bit long.
 
-            The main structure to watch for is calls to self.target_func(...), which is defined
+            The main structure to watch for is calls to target_func(...), which is defined
             downstream. All other code is essentially boilerplate to tie this target to the
             predictions, i.e. to construct a feedback signal for training.
 
@@ -390,93 +756,94 @@ class BaseTDLearningQ(BaseTDLearning):
             -kris
 
             """
-            rngs = hk.PRNGSequence(rng)
-            S = self.q.observation_preprocessor(next(rngs), transition_batch.S)
-            A = self.q.action_preprocessor(next(rngs), transition_batch.A)
+            rngs = jax.random.split(rng, 9)
+            S = self.q.observation_preprocessor(rngs[0], transition_batch.S)
+            A = self.q.action_preprocessor(rngs[1], transition_batch.A)
             W = jnp.clip(transition_batch.W, 0.1, 10.)  # clip importance weights to reduce variance
-
-            metrics = {}
+            mask, frac_valid = _mask_and_frac_valid(mask)  # the mask is None if there's no padding
+            W *= mask
 
             # regularization term
-            if self.policy_regularizer is None:
-                regularizer = 0.
-            else:
-                regularizer, regularizer_metrics = self.policy_regularizer.batch_eval(
-                    target_params['reg'], target_params['reg_hparams'], target_state['reg'],
-                    next(rngs), transition_batch)
-                metrics.update({f'{self.__class__.__name__}/{k}': v for k,
-                               v in regularizer_metrics.items()})
+            regularizer, metrics = \
+                policy_regularizer_func(target_params, target_state, rngs[2], transition_batch)
 
             if is_stochastic(self.q):
                 dist_params, state_new = \
-                    self.q.function_type1(params, state, next(rngs), S, A, True)
+                    self.q.function_type1(params, state, rngs[3], S, A, True)
                 dist_params_target = \
-                    self.target_func(target_params, target_state, rng, transition_batch)
+                    target_func(target_params, target_state, rngs[4], transition_batch)
 
                 if self.policy_regularizer is not None:
                     dist_params_target = self.q.proba_dist.affine_transform(
                         dist_params_target, 1., -regularizer, self.q.value_transform)
 
                 if isinstance(self.q.proba_dist, DiscretizedIntervalDist):
-                    loss = jnp.mean(self.q.proba_dist.cross_entropy(dist_params_target,
-                                                                    dist_params))
+                    loss = jnp.mean(mask * self.q.proba_dist.cross_entropy(
+                        dist_params_target, dist_params))
                 elif isinstance(self.q.proba_dist, EmpiricalQuantileDist):
                     loss = quantile_huber(dist_params_target['values'],
                                           dist_params['values'],
                                           dist_params['quantile_fractions'], W)
+                loss /= frac_valid
 
                 # the rest here is only needed for metrics dict
                 Q = self.q.proba_dist.mean(dist_params)
-                Q = self.q.proba_dist.postprocess_variate(next(rngs), Q, batch_mode=True)
+                Q = self.q.proba_dist.postprocess_variate(rngs[5], Q, batch_mode=True)
                 G = self.q.proba_dist.mean(dist_params_target)
-                G = self.q.proba_dist.postprocess_variate(next(rngs), G, batch_mode=True)
+                G = self.q.proba_dist.postprocess_variate(rngs[6], G, batch_mode=True)
                 dist_params_q_targ, _ = self.q.function_type1(
-                    target_params['q_targ'], target_state['q_targ'], next(rngs), S, A, False)
+                    target_params['q_targ'], target_state['q_targ'], rngs[7], S, A, False)
                 Q_targ = self.q.proba_dist.mean(dist_params_q_targ)
-                Q_targ = self.q.proba_dist.postprocess_variate(next(rngs), Q_targ, batch_mode=True)
+                Q_targ = self.q.proba_dist.postprocess_variate(rngs[8], Q_targ, batch_mode=True)
 
             else:
-                Q, state_new = self.q.function_type1(params, state, next(rngs), S, A, True)
-                G = self.target_func(target_params, target_state, next(rngs), transition_batch)
+                Q, state_new = self.q.function_type1(params, state, rngs[3], S, A, True)
+                G = target_func(target_params, target_state, rngs[4], transition_batch)
                 # flip sign (typical example: regularizer = -beta * entropy)
                 G -= regularizer
-                loss = self.loss_function(G, Q, W)
+                loss = loss_function(G, Q, W) / frac_valid
 
                 # only needed for metrics dict
                 Q_targ, _ = self.q.function_type1(
-                    target_params['q_targ'], target_state['q_targ'], next(rngs), S, A, False)
+                    target_params['q_targ'], target_state['q_targ'], rngs[7], S, A, False)
 
             chex.assert_equal_shape([G, Q, Q_targ, W])
             chex.assert_rank([G, Q, Q_targ, W], 1)
-            dLoss_dQ = jax.grad(self.loss_function, argnums=1)
             td_error = -Q.shape[0] * dLoss_dQ(G, Q)  # e.g. (G - Q) if loss function is MSE
             chex.assert_equal_shape([td_error, W])
+            td_error_mean, td_error_targ_mean = \
+                _metrics_mean(W * td_error, -dLoss_dQ(Q, Q_targ, W))
             metrics.update({
                 f'{self.__class__.__name__}/loss': loss,
-                f'{self.__class__.__name__}/td_error': jnp.mean(W * td_error),
-                f'{self.__class__.__name__}/td_error_targ': jnp.mean(-dLoss_dQ(Q, Q_targ, W)),
+                f'{self.__class__.__name__}/td_error': td_error_mean / frac_valid,
+                f'{self.__class__.__name__}/td_error_targ': td_error_targ_mean / frac_valid ** 2,
             })
-            return loss, (td_error, state_new, metrics)
+            return loss, _LossAux(td_error, state_new, metrics)
 
         def grads_and_metrics_func(
-                params, target_params, state, target_state, rng, transition_batch):
+                params, target_params, state, target_state, rng, transition_batch, mask=None):
 
-            rngs = hk.PRNGSequence(rng)
-            grads, (td_error, state_new, metrics) = jax.grad(loss_func, has_aux=True)(
-                params, target_params, state, target_state, next(rngs), transition_batch)
+            grads, aux = jax.grad(loss_func, has_aux=True)(
+                params, target_params, state, target_state, rng, transition_batch, mask)
+            td_error, state_new, metrics = aux
 
             # add some diagnostics about the gradients
             metrics.update(get_grads_diagnostics(grads, f'{self.__class__.__name__}/grads_'))
 
             return grads, state_new, metrics, td_error
 
-        def td_error_func(params, target_params, state, target_state, rng, transition_batch):
-            loss, (td_error, state_new, metrics) =\
-                loss_func(params, target_params, state, target_state, rng, transition_batch)
-            return td_error
+        def td_error_func(
+                params, target_params, state, target_state, rng, transition_batch, mask=None):
+            _, aux = loss_func(
+                params, target_params, state, target_state, rng, transition_batch, mask)
+            return aux.td_error
 
-        self._grads_and_metrics_func = jit(grads_and_metrics_func)
-        self._td_error_func = jit(td_error_func)
+        name = self.__class__.__name__
+        self._grads_and_metrics_func_pure = grads_and_metrics_func  # inlined by the update funcs
+        self._grads_and_metrics_func = jit(_warn_on_retrace(
+            grads_and_metrics_func, f'{name}.grads_and_metrics', self._retrace_threshold_and_hint))
+        self._td_error_func = jit(_warn_on_retrace(
+            td_error_func, f'{name}.td_error', self._retrace_threshold_and_hint))
 
     @property
     def q(self):
@@ -488,7 +855,7 @@ class BaseTDLearningQ(BaseTDLearning):
 
     @property
     def target_params(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_params', {
             'q': self.q.params,
             'q_targ': self.q_targ.params,
             'reg': getattr(getattr(self.policy_regularizer, 'f', None), 'params', None),
@@ -496,7 +863,7 @@ class BaseTDLearningQ(BaseTDLearning):
 
     @property
     def target_function_state(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_function_state', {
             'q': self.q.function_state,
             'q_targ': self.q_targ.function_state,
             'reg': getattr(getattr(self.policy_regularizer, 'f', None), 'function_state', None)})
@@ -536,7 +903,7 @@ class BaseTDLearningQWithTargetPolicy(BaseTDLearningQ):
 
     @property
     def target_params(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_params', {
             'q': self.q.params,
             'q_targ': self.q_targ.params,
             'pi_targ': getattr(self.pi_targ, 'params', None),
@@ -545,7 +912,7 @@ class BaseTDLearningQWithTargetPolicy(BaseTDLearningQ):
 
     @property
     def target_function_state(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_function_state', {
             'q': self.q.function_state,
             'q_targ': self.q_targ.function_state,
             'pi_targ': getattr(self.pi_targ, 'function_state', None),
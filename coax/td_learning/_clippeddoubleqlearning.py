@@ -10,7 +10,8 @@ from ..proba_dists import DiscretizedIntervalDist, EmpiricalQuantileDist
 from ..utils import (get_grads_diagnostics, is_policy, is_qfunction,
                      is_stochastic, jit, single_to_batch, batch_to_single, stack_trees)
 from ..value_losses import quantile_huber
-from ._base import BaseTDLearningQ
+from ._base import (BaseTDLearningQ, _LossAux, _mask_and_frac_valid, _metrics_mean,
+                    _warn_on_retrace)
 
 
 class ClippedDoubleQLearning(BaseTDLearningQ):  # TODO(krholshe): make this less ugly
@@ -117,64 +118,65 @@ class ClippedDoubleQLearning(BaseTDLearningQ):  # TODO(krholshe): make this less
         elif len(self.q_targ_list) * len(self.pi_targ_list) < 2:
             raise ValueError("len(q_targ_list) * len(pi_targ_list) must be at least 2")
 
-        def loss_func(params, target_params, state, target_state, rng, transition_batch):
-            rngs = hk.PRNGSequence(rng)
-            S = self.q.observation_preprocessor(next(rngs), transition_batch.S)
-            A = self.q.action_preprocessor(next(rngs), transition_batch.A)
+        loss_function = self.loss_function
+        target_func = self.target_func
+        policy_regularizer_func = self._policy_regularizer_func
+        dLoss_dQ = jax.grad(loss_function, argnums=1)
+
+        def loss_func(params, target_params, state, target_state, rng, transition_batch, mask=None):
+            rngs = jax.random.split(rng, 7 + 2 * len(self.q_targ_list))
+            S = self.q.observation_preprocessor(rngs[0], transition_batch.S)
+            A = self.q.action_preprocessor(rngs[1], transition_batch.A)
             W = jnp.clip(transition_batch.W, 0.1, 10.)  # clip importance weights to reduce variance
+            mask, frac_valid = _mask_and_frac_valid(mask)  # the mask is None if there's no padding
+            W *= mask
 
-            metrics = {}
             # regularization term
-            if self.policy_regularizer is None:
-                regularizer = 0.
-            else:
-                regularizer, regularizer_metrics = self.policy_regularizer.batch_eval(
-                    target_params['reg'], target_params['reg_hparams'], target_state['reg'],
-                    next(rngs), transition_batch)
-                metrics.update({f'{self.__class__.__name__}/{k}': v for k,
-                               v in regularizer_metrics.items()})
+            regularizer, metrics = \
+                policy_regularizer_func(target_params, target_state, rngs[2], transition_batch)
 
             if is_stochastic(self.q):
                 dist_params, state_new = \
-                    self.q.function_type1(params, state, next(rngs), S, A, True)
+                    self.q.function_type1(params, state, rngs[3], S, A, True)
                 dist_params_target = \
-                    self.target_func(target_params, target_state, rng, transition_batch)
+                    target_func(target_params, target_state, rngs[4], transition_batch)
 
                 if self.policy_regularizer is not None:
                     dist_params_target = self.q.proba_dist.affine_transform(
                         dist_params_target, 1., -regularizer, self.q.value_transform)
 
                 if isinstance(self.q.proba_dist, DiscretizedIntervalDist):
-                    loss = jnp.mean(self.q.proba_dist.cross_entropy(dist_params_target,
-                                                                    dist_params))
+                    loss = jnp.mean(mask * self.q.proba_dist.cross_entropy(
+                        dist_params_target, dist_params))
                 elif isinstance(self.q.proba_dist, EmpiricalQuantileDist):
                     loss = quantile_huber(dist_params_target['values'],
                                           dist_params['values'],
                                           dist_params['quantile_fractions'], W)
+                loss /= frac_valid
                 # the rest here is only needed for metrics dict
                 Q = self.q.proba_dist.mean(dist_params)
-                Q = self.q.proba_dist.postprocess_variate(next(rngs), Q, batch_mode=True)
+                Q = self.q.proba_dist.postprocess_variate(rngs[5], Q, batch_mode=True)
                 G = self.q.proba_dist.mean(dist_params_target)
-                G = self.q.proba_dist.postprocess_variate(next(rngs), G, batch_mode=True)
+                G = self.q.proba_dist.postprocess_variate(rngs[6], G, batch_mode=True)
             else:
-                Q, state_new = self.q.function_type1(params, state, next(rngs), S, A, True)
-                G = self.target_func(target_params, target_state, next(rngs), transition_batch)
+                Q, state_new = self.q.function_type1(params, state, rngs[3], S, A, True)
+                G = target_func(target_params, target_state, rngs[4], transition_batch)
                 # flip sign (typical example: regularizer = -beta * entropy)
                 G -= regularizer
-                loss = self.loss_function(G, Q, W)
+                loss = loss_function(G, Q, W) / frac_valid
 
-            dLoss_dQ = jax.grad(self.loss_function, argnums=1)
             td_error = -Q.shape[0] * dLoss_dQ(G, Q)  # e.g. (G - Q) if loss function is MSE
 
             # target-network estimate (is this worth computing?)
             Q_targ_list = []
             qs = list(zip(self.q_targ_list, target_params['q_targ'], target_state['q_targ']))
-            for q, pm, st in qs:
+            for i, (q, pm, st) in enumerate(qs):
+                rng_q, rng_pp = rngs[7 + 2 * i], rngs[8 + 2 * i]
                 if is_stochastic(q):
-                    Q_targ = q.mean_func_type1(pm, st, next(rngs), S, A)
-                    Q_targ = q.proba_dist.postprocess_variate(next(rngs), Q_targ, batch_mode=True)
+                    Q_targ = q.mean_func_type1(pm, st, rng_q, S, A)
+                    Q_targ = q.proba_dist.postprocess_variate(rng_pp, Q_targ, batch_mode=True)
                 else:
-                    Q_targ, _ = q.function_type1(pm, st, next(rngs), S, A, False)
+                    Q_targ, _ = q.function_type1(pm, st, rng_q, S, A, False)
                 assert Q_targ.ndim == 1, f"bad shape: {Q_targ.shape}"
                 Q_targ_list.append(Q_targ)
             Q_targ_list = jnp.stack(Q_targ_list, axis=-1)
@@ -182,36 +184,43 @@ class ClippedDoubleQLearning(BaseTDLearningQ):  # TODO(krholshe): make this less
             Q_targ = jnp.min(Q_targ_list, axis=-1)
 
             chex.assert_equal_shape([td_error, W, Q_targ])
+            td_error_mean, td_error_targ_mean = \
+                _metrics_mean(W * td_error, -dLoss_dQ(Q, Q_targ, W))
             metrics.update({
                 f'{self.__class__.__name__}/loss': loss,
-                f'{self.__class__.__name__}/td_error': jnp.mean(W * td_error),
-                f'{self.__class__.__name__}/td_error_targ': jnp.mean(-dLoss_dQ(Q, Q_targ, W)),
+                f'{self.__class__.__name__}/td_error': td_error_mean / frac_valid,
+                f'{self.__class__.__name__}/td_error_targ': td_error_targ_mean / frac_valid ** 2,
             })
-            return loss, (td_error, state_new, metrics)
+            return loss, _LossAux(td_error, state_new, metrics)
 
         def grads_and_metrics_func(
-                params, target_params, state, target_state, rng, transition_batch):
+                params, target_params, state, target_state, rng, transition_batch, mask=None):
 
-            rngs = hk.PRNGSequence(rng)
-            grads, (td_error, state_new, metrics) = jax.grad(loss_func, has_aux=True)(
-                params, target_params, state, target_state, next(rngs), transition_batch)
+            grads, aux = jax.grad(loss_func, has_aux=True)(
+                params, target_params, state, target_state, rng, transition_batch, mask)
+            td_error, state_new, metrics = aux
 
             # add some diagnostics about the gradients
             metrics.update(get_grads_diagnostics(grads, f'{self.__class__.__name__}/grads_'))
 
             return grads, state_new, metrics, td_error
 
-        def td_error_func(params, target_params, state, target_state, rng, transition_batch):
-            loss, (td_error, state_new, metrics) =\
-                loss_func(params, target_params, state, target_state, rng, transition_batch)
-            return td_error
+        def td_error_func(
+                params, target_params, state, target_state, rng, transition_batch, mask=None):
+            _, aux = loss_func(
+                params, target_params, state, target_state, rng, transition_batch, mask)
+            return aux.td_error
 
-        self._grads_and_metrics_func = jit(grads_and_metrics_func)
-        self._td_error_func = jit(td_error_func)
+        name = self.__class__.__name__
+        self._grads_and_metrics_func_pure = grads_and_metrics_func  # inlined by the update funcs
+        self._grads_and_metrics_func = jit(_warn_on_retrace(
+            grads_and_metrics_func, f'{name}.grads_and_metrics', self._retrace_threshold_and_hint))
+        self._td_error_func = jit(_warn_on_retrace(
+            td_error_func, f'{name}.td_error', self._retrace_threshold_and_hint))
 
     @property
     def target_params(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_params', {
             'q': self.q.params,
             'q_targ': [q.params for q in self.q_targ_list],
             'pi_targ': [pi.params for pi in self.pi_targ_list],
@@ -220,7 +229,7 @@ class ClippedDoubleQLearning(BaseTDLearningQ):  # TODO(krholshe): make this less
 
     @property
     def target_function_state(self):
-        return hk.data_structures.to_immutable_dict({
+        return self._to_immutable_dict_cached('target_function_state', {
             'q': self.q.function_state,
             'q_targ': [q.function_state for q in self.q_targ_list],
             'pi_targ': [pi.function_state for pi in self.pi_targ_list],
@@ -1,5 +1,7 @@
 from copy import deepcopy
 
+import haiku as hk
+import jax.numpy as jnp
 from optax import sgd
 
 from .._base.test_case import TestCase
@@ -41,6 +43,33 @@ class TestClippedDoubleQLearning(TestCase):
         self.assertPytreeNotEqual(function_state1, q1.function_state)
         self.assertPytreeNotEqual(function_state2, q2.function_state)
 
+    def test_update_pad_batches(self):
+        env = self.env_discrete
+        transition_batch = get_transition_batch(env, batch_size=5, random_seed=42)
+
+        def func_q(S, is_training):
+            # no batch norm, because the padded rows would affect the batch statistics
+            n = env.action_space.n
+            return hk.Sequential((hk.Flatten(), hk.Linear(7), jnp.tanh, hk.Linear(n)))(S)
+
+        def update(pad_batches):
+            q = Q(func_q, env, random_seed=11)
+            q_targ_list = [Q(func_q, env, random_seed=13), Q(func_q, env, random_seed=17)]
+            updater = ClippedDoubleQLearning(q, q_targ_list=q_targ_list, optimizer=sgd(1.0))
+            updater.pad_batches = pad_batches
+            metrics, td_error = updater.update(transition_batch, return_td_error=True)
+            return q.params, metrics, td_error
+
+        params, metrics, td_error = update(pad_batches=False)
+        params_padded, metrics_padded, td_error_padded = update(pad_batches=True)
+
+        # the padded rows shouldn't make a difference
+        self.assertEqual(td_error_padded.shape, (5,))
+        self.assertArrayAlmostEqual(td_error_padded, td_error)
+        self.assertAlmostEqual(
+            metrics_padded['ClippedDoubleQLearning/loss'], metrics['ClippedDoubleQLearning/loss'])
+        self.assertPytreeAlmostEqual(params_padded, params)
+
     def test_update_discrete_stochastic_type1(self):
         env = self.env_discrete
         func_q = self.func_q_stochastic_type1
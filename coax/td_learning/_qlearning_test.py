@@ -1,11 +1,14 @@
 from copy import deepcopy
 
+import haiku as hk
+import jax.numpy as jnp
 from optax import sgd
 
 from .._base.test_case import TestCase
 from .._core.q import Q
+from .._core.stochastic_q import StochasticQ
 from .._core.policy import Policy
-from ..utils import get_transition_batch
+from ..utils import get_transition_batch, quantiles
 from ._qlearning import QLearning
 
 
@@ -99,3 +102,53 @@ class TestQLearning(TestCase):
         msg = r"pi_targ must be a Policy, got: .*"
         with self.assertRaisesRegex(TypeError, msg):
             QLearning(q, q_targ)
+
+    def test_update_pad_batches(self):
+        # no batch norm in these funcs, because the padded rows would affect the batch statistics
+        n = self.env_discrete.action_space.n
+
+        def func_q(S, is_training):
+            seq = hk.Sequential((hk.Flatten(), hk.Linear(7), jnp.tanh, hk.Linear(n)))
+            return seq(S)
+
+        def func_q_stochastic(S, is_training):
+            seq = hk.Sequential((
+                hk.Flatten(), hk.Linear(7), jnp.tanh, hk.Linear(n * 11), hk.Reshape((n, 11))))
+            return {'logits': seq(S)}
+
+        def func_q_quantile(S, A, is_training):
+            quantile_fractions = quantiles(batch_size=S.shape[0], num_quantiles=11)
+            X = jnp.concatenate((hk.Flatten()(S), A, quantile_fractions), axis=-1)
+            seq = hk.Sequential((hk.Linear(7), jnp.tanh, hk.Linear(11)))
+            return {'values': seq(X), 'quantile_fractions': quantile_fractions}
+
+        funcs = {
+            'deterministic': lambda seed: Q(func_q, self.env_discrete, random_seed=seed),
+            'discretized': lambda seed: StochasticQ(
+                func_q_stochastic, self.env_discrete, value_range=(0, 1), num_bins=11,
+                random_seed=seed),
+            'quantile': lambda seed: StochasticQ(
+                func_q_quantile, self.env_discrete, num_bins=11, random_seed=seed),
+        }
+        transition_batch = get_transition_batch(self.env_discrete, batch_size=5, random_seed=42)
+        for name, make_q in funcs.items():
+            with self.subTest(name):
+                q = make_q(11)
+                updater = QLearning(q, q_targ=make_q(13), optimizer=sgd(1.0))
+                metrics, td_error = updater.update(transition_batch, return_td_error=True)
+
+                # the padded rows shouldn't make a difference
+                q_padded = make_q(11)
+                updater_padded = QLearning(q_padded, q_targ=make_q(13), optimizer=sgd(1.0))
+                updater_padded.pad_batches = True
+                metrics_padded, td_error_padded = \
+                    updater_padded.update(transition_batch, return_td_error=True)
+
+                self.assertEqual(td_error_padded.shape, (5,))
+                self.assertArrayAlmostEqual(td_error_padded, td_error)
+                self.assertAlmostEqual(metrics_padded['QLearning/loss'], metrics['QLearning/loss'])
+                for k in ('td_error', 'td_error_targ'):  # these metrics are averaged in bfloat16
+                    self.assertAlmostEqual(
+                        metrics_padded[f'QLearning/{k}'], metrics[f'QLearning/{k}'], decimal=3)
+                self.assertPytreeAlmostEqual(q_padded.params, q.params)
+                self.assertPytreeNotEqual(q.params, make_q(11).params)
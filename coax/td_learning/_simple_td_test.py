@@ -1,5 +1,14 @@
+import os
+import subprocess
+import sys
+import warnings
 from copy import deepcopy
+from unittest.mock import patch
 
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as onp
 from optax import sgd
 
 from .._base.test_case import TestCase
@@ -8,9 +17,58 @@ from .._core.policy import Policy
 from ..utils import get_transition_batch
 from ..regularizers import EntropyRegularizer
 from ..value_transforms import LogTransform
+from ._base import _pad_batch, _warn_on_retrace
 from ._simple_td import SimpleTD
 
 
+# compares update() with replicated=True to a single-device update() on batches that leave some
+# shards (partially) padded, including shards that are all padding
+REPLICATED_SCRIPT = """
+import jax
+import jax.numpy as jnp
+import haiku as hk
+import numpy as onp
+from optax import sgd
+
+from coax import V
+from coax._base.test_case import DiscreteEnv
+from coax.td_learning import SimpleTD
+from coax.utils import get_transition_batch
+
+assert jax.local_device_count() == 4, jax.local_device_count()
+env = DiscreteEnv(42)
+
+
+def func_v(S, is_training):
+    seq = hk.Sequential((hk.Flatten(), hk.Linear(7), jnp.tanh, hk.Linear(1), jnp.ravel))
+    return seq(S)
+
+
+for batch_size, pad_batches in ((3, False), (5, False), (5, True), (8, False), (16, False)):
+    transition_batch = get_transition_batch(env, batch_size=batch_size, random_seed=42)
+
+    v = V(func_v, env, random_seed=11)
+    v_targ = V(func_v, env, random_seed=13)  # so that the td_error_targ metric isn't zero
+    metrics, td_error = SimpleTD(v, v_targ, optimizer=sgd(1.0)).update(
+        transition_batch, return_td_error=True)
+
+    v_rep = V(func_v, env, random_seed=11)
+    updater_rep = SimpleTD(v_rep, v_targ, optimizer=sgd(1.0))
+    updater_rep.replicated, updater_rep.pad_batches = True, pad_batches
+    metrics_rep, td_error_rep = updater_rep.update(transition_batch, return_td_error=True)
+
+    assert td_error_rep.shape == (batch_size,), td_error_rep.shape
+    onp.testing.assert_allclose(metrics_rep['SimpleTD/loss'], metrics['SimpleTD/loss'], rtol=1e-5)
+    for k in ('SimpleTD/grads_max', 'SimpleTD/grads_norm'):
+        onp.testing.assert_allclose(metrics_rep[k], metrics[k], rtol=1e-5)
+    for k in ('SimpleTD/td_error', 'SimpleTD/td_error_targ'):  # these are averaged in bfloat16
+        onp.testing.assert_allclose(metrics_rep[k], metrics[k], rtol=1e-2)
+    assert metrics_rep['SimpleTD/grads_has_nan'] == 0.
+    for x, y in zip(jax.tree_util.tree_leaves(v_rep.params), jax.tree_util.tree_leaves(v.params)):
+        onp.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-6)
+"""
+
+
 class TestSimpleTD(TestCase):
 
     def setUp(self):
@@ -161,3 +219,229 @@ class TestSimpleTD(TestCase):
         self.assertPytreeNotEqual(function_state_with_reg, function_state_init)
         self.assertPytreeNotEqual(params_with_reg, params_without_reg)
         self.assertPytreeAlmostEqual(function_state_with_reg, function_state_without_reg)  # same!
+
+    def test_update_nan_grads(self):
+        env = self.env_discrete
+        func_v = self.func_v
+        transition_batch = deepcopy(self.transition_discrete)
+        transition_batch.Rn[0] = float('nan')
+
+        v = V(func_v, env, random_seed=11)
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+
+        # by default, nan's are only reported in the metrics (as a float, so that it averages well)
+        metrics = updater.update(self.transition_discrete)
+        self.assertEqual(metrics['SimpleTD/grads_has_nan'], 0.)
+        self.assertEqual(metrics['SimpleTD/grads_has_nan'].dtype, jnp.float32)
+        metrics = updater.update(transition_batch)
+        self.assertEqual(metrics['SimpleTD/grads_has_nan'], 1.)
+
+        # COAX_DEBUG_NAN=0 doesn't enable debug mode
+        with patch.dict('os.environ', {'COAX_DEBUG_NAN': '0'}):
+            updater.update(transition_batch)
+
+        # debug mode raises instead
+        v = V(func_v, env, random_seed=11)
+        updater = SimpleTD(v)  # default optimizer (adam) has a non-empty state, which is donated
+        params = deepcopy(v.params)
+        with patch.dict('os.environ', {'COAX_DEBUG_NAN': '1'}):
+            with self.assertRaisesRegex(RuntimeError, "found nan's in grads"):
+                updater.update(transition_batch)
+
+            # nothing was applied, and the updater is still usable
+            self.assertPytreeAlmostEqual(v.params, params)
+            updater.update(self.transition_discrete)
+        self.assertPytreeNotEqual(v.params, params)
+
+    def test_update_pad_batches(self):
+        env = self.env_discrete
+        transition_batch = get_transition_batch(env, batch_size=5, random_seed=42)
+
+        def func_v(S, is_training):
+            # no batch norm, because the padded rows would affect the batch statistics
+            seq = hk.Sequential((hk.Flatten(), hk.Linear(7), jnp.tanh, hk.Linear(1), jnp.ravel))
+            return seq(S)
+
+        v = V(func_v, env, random_seed=11)
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+        metrics, td_error = updater.update(transition_batch, return_td_error=True)
+
+        v_padded = V(func_v, env, random_seed=11)
+        updater_padded = SimpleTD(v_padded, optimizer=sgd(1.0))
+        updater_padded.pad_batches = True
+        metrics_padded, td_error_padded = \
+            updater_padded.update(transition_batch, return_td_error=True)
+
+        # padded rows shouldn't make a difference
+        self.assertEqual(td_error_padded.shape, (5,))
+        self.assertArrayAlmostEqual(td_error_padded, td_error)
+        self.assertAlmostEqual(metrics_padded['SimpleTD/loss'], metrics['SimpleTD/loss'])
+        self.assertAlmostEqual(
+            metrics_padded['SimpleTD/td_error_targ'], metrics['SimpleTD/td_error_targ'])
+        self.assertPytreeAlmostEqual(v_padded.params, v.params)
+
+    def test_update_warn_on_retrace(self):
+        v = V(self.func_v, self.env_discrete, random_seed=11)
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+        for batch_size in (5, 6, 7):
+            updater.td_error(get_transition_batch(self.env_discrete, batch_size=batch_size))
+        with self.assertWarnsRegex(UserWarning, r"SimpleTD\.td_error was recompiled") as cm:
+            updater.td_error(get_transition_batch(self.env_discrete, batch_size=8))
+        self.assertEqual(cm.filename, __file__)  # the warning points at the caller
+
+        # update() inlines grads_and_metrics, which therefore doesn't warn separately
+        for batch_size in (5, 6, 7):
+            updater.update(get_transition_batch(self.env_discrete, batch_size=batch_size))
+        with warnings.catch_warnings(record=True) as ws:
+            warnings.simplefilter('always')
+            updater.update(get_transition_batch(self.env_discrete, batch_size=8))
+        self.assertEqual([str(w.message).split()[0] for w in ws], ['SimpleTD.update'])
+        self.assertEqual(ws[0].filename, __file__)
+
+        # the hint depends on the function, e.g. the batch size doesn't affect apply_grads()
+        func = _warn_on_retrace(jnp.sum, 'foo', lambda: (1, "bar"))
+        func(jnp.zeros(1))
+        with self.assertWarnsRegex(UserWarning, r"foo was recompiled .*; bar$"):
+            func(jnp.zeros(2))
+
+        # padding to a power of two avoids the recompilations
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+        updater.pad_batches = True
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            for batch_size in (5, 6, 7, 8, 9, 10, 11, 12):
+                updater.td_error(get_transition_batch(self.env_discrete, batch_size=batch_size))
+
+            # the few padded batch sizes that remain are expected, so they don't warn either
+            for batch_size in (5, 12, 30, 60, 100):
+                updater.update(get_transition_batch(self.env_discrete, batch_size=batch_size))
+
+    def test_pad_batch_device_resident(self):
+        transition_batch = jax.device_put(
+            get_transition_batch(self.env_discrete, batch_size=5, random_seed=42))
+
+        # padding a batch that's already on the device shouldn't copy it to the host and back
+        transition_batch_padded, mask = _pad_batch(transition_batch, pow2=True)
+        self.assertEqual(transition_batch_padded.batch_size, 8)
+        self.assertEqual(mask.tolist(), [True] * 5 + [False] * 3)
+        for leaf in jax.tree_util.tree_leaves(transition_batch_padded):
+            self.assertIsInstance(leaf, jax.Array)
+
+    def test_target_params_cached(self):
+        v = V(self.func_v, self.env_discrete, random_seed=11)
+        pi = Policy(self.func_pi_discrete, self.env_discrete, random_seed=17)
+        policy_reg = EntropyRegularizer(pi, beta=1.0)
+        updater = SimpleTD(v, optimizer=sgd(1.0), policy_regularizer=policy_reg)
+
+        # the regularizer's hyperparams dict is recreated on every access
+        self.assertIs(updater.target_params, updater.target_params)
+        self.assertIs(updater.target_function_state, updater.target_function_state)
+
+        # but changes are picked up
+        target_params = updater.target_params
+        policy_reg.beta = 0.5
+        self.assertIsNot(updater.target_params, target_params)
+        self.assertEqual(updater.target_params['reg_hparams']['beta'], 0.5)
+
+    def test_zero_weights_are_clipped(self):
+        v = V(self.func_v, self.env_discrete, random_seed=11)
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+        transition_batch = get_transition_batch(self.env_discrete, batch_size=5, random_seed=42)
+
+        # a zero weight is clipped like any other small weight, it doesn't mark a padded row
+        transition_batch.W[0] = 0.
+        _, _, metrics_zero, _ = updater.grads_and_metrics(transition_batch)
+        transition_batch.W[0] = 1e-9
+        _, _, metrics_tiny, _ = updater.grads_and_metrics(transition_batch)
+        self.assertAlmostEqual(metrics_zero['SimpleTD/loss'], metrics_tiny['SimpleTD/loss'])
+
+    def test_update_replicated(self):
+        # the number of (cpu) devices must be set before jax is initialized, hence the subprocess
+        env = dict(
+            os.environ, XLA_FLAGS='--xla_force_host_platform_device_count=4',
+            PYTHONPATH=os.pathsep.join(
+                (os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                 os.environ.get('PYTHONPATH', ''))))
+        result = subprocess.run(
+            [sys.executable, '-c', REPLICATED_SCRIPT], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, msg=result.stderr)
+
+    def test_update_donated_optimizer_state(self):
+        v = V(self.func_v, self.env_discrete, random_seed=11)
+        updater = SimpleTD(v)  # default optimizer (adam) has a non-empty state
+
+        optimizer_state_old = updater.optimizer_state
+        updater.update(self.transition_discrete)
+        updater.optimizer_state = optimizer_state_old
+        with self.assertRaisesRegex(ValueError, "optimizer_state is donated"):
+            updater.update(self.transition_discrete)
+
+    def test_apply_grads_host_arrays(self):
+        v = V(self.func_v, self.env_discrete, random_seed=11)
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+        grads, function_state, _, _ = updater.grads_and_metrics(self.transition_discrete)
+
+        # e.g. grads that were computed in a separate process
+        grads, function_state = jax.tree_util.tree_map(onp.asarray, (grads, function_state))
+        params = deepcopy(v.params)
+        updater.apply_grads(grads, function_state)
+
+        self.assertPytreeNotEqual(params, v.params)
+        for leaf in jax.tree_util.tree_leaves(v.function_state):
+            self.assertIsInstance(leaf, jax.Array)
+
+    def test_precompile(self):
+        v = V(self.func_v, self.env_discrete, random_seed=11)
+        updater = SimpleTD(v, optimizer=sgd(1.0))
+        metrics = updater.update(self.transition_discrete)
+
+        # precompiling shouldn't update anything, nor should it alter the random stream
+        v_precompiled = V(self.func_v, self.env_discrete, random_seed=11)
+        updater_precompiled = SimpleTD(v_precompiled, optimizer=sgd(1.0))
+        updater_precompiled.precompile(self.transition_discrete)
+        self.assertPytreeAlmostEqual(v_precompiled.params, V(
+            self.func_v, self.env_discrete, random_seed=11).params)
+        metrics_precompiled = updater_precompiled.update(self.transition_discrete)
+
+        self.assertPytreeAlmostEqual(v_precompiled.params, v.params)
+        self.assertAlmostEqual(metrics_precompiled['SimpleTD/loss'], metrics['SimpleTD/loss'])
+
+    def test_update_accumulation_steps(self):
+        env = self.env_discrete
+        transition_batch = get_transition_batch(env, batch_size=5, random_seed=42)
+
+        def func_v(S, is_training):
+            seq = hk.Sequential((hk.Flatten(), hk.Linear(7), jnp.tanh, hk.Linear(1), jnp.ravel))
+            return seq(S)
+
+        v = V(func_v, env, random_seed=11)
+        v_targ = V(func_v, env, random_seed=13)  # so that the td_error_targ metric isn't zero
+        updater = SimpleTD(v, v_targ, optimizer=sgd(1.0))
+        metrics, td_error = updater.update(transition_batch, return_td_error=True)
+
+        # micro-batches of sizes 3 and 2 (+1 padded row)
+        v_acc = V(func_v, env, random_seed=11)
+        updater_acc = SimpleTD(v_acc, v_targ, optimizer=sgd(1.0))
+        metrics_acc, td_error_acc = updater_acc.update(
+            transition_batch, return_td_error=True, accumulation_steps=2)
+
+        self.assertEqual(td_error_acc.shape, (5,))
+        self.assertAlmostEqual(metrics_acc['SimpleTD/loss'], metrics['SimpleTD/loss'])
+        self.assertAlmostEqual(metrics_acc['SimpleTD/grads_norm'], metrics['SimpleTD/grads_norm'])
+        for k in ('SimpleTD/td_error', 'SimpleTD/td_error_targ'):  # these are averaged in bfloat16
+            self.assertAlmostEqual(metrics_acc[k] / metrics[k], 1., decimal=2)
+        self.assertPytreeAlmostEqual(v_acc.params, v.params)
+
+        # padded to 8 rows, i.e. micro-batches of 2, the last of which is all padding
+        v_pad = V(func_v, env, random_seed=11)
+        updater_pad = SimpleTD(v_pad, v_targ, optimizer=sgd(1.0))
+        updater_pad.pad_batches = True
+        metrics_pad = updater_pad.update(transition_batch, accumulation_steps=4)
+
+        self.assertEqual(metrics_pad['SimpleTD/grads_has_nan'], 0.)
+        self.assertAlmostEqual(metrics_pad['SimpleTD/loss'], metrics['SimpleTD/loss'])
+        self.assertPytreeAlmostEqual(v_pad.params, v.params)
+
+        msg = r"accumulation_steps=6 exceeds the batch size: 5"
+        with self.assertRaisesRegex(ValueError, msg):
+            updater_pad.update(transition_batch, accumulation_steps=6)
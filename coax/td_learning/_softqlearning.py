@@ -92,6 +92,17 @@ class SoftQLearning(BaseTDLearningQ):
             loss_function=loss_function,
             policy_regularizer=policy_regularizer)
 
+    @property
+    def target_params(self):
+        # pass the temperature as a traced value, so that changing it doesn't go unnoticed by (or
+        # trigger a recompilation of) the jitted functions
+        return self._to_immutable_dict_cached('target_params', {
+            'q': self.q.params,
+            'q_targ': self.q_targ.params,
+            'reg': getattr(getattr(self.policy_regularizer, 'f', None), 'params', None),
+            'reg_hparams': getattr(self.policy_regularizer, 'hyperparams', None),
+            'temperature': self.temperature})
+
     def target_func(self, target_params, target_state, rng, transition_batch):
         rngs = hk.PRNGSequence(rng)
         params, state = target_params['q_targ'], target_state['q_targ']
@@ -99,7 +110,8 @@ class SoftQLearning(BaseTDLearningQ):
         Q_s_next, _ = self.q_targ.function_type2(params, state, next(rngs), S_next, False)
         assert Q_s_next.ndim == 2
         assert Q_s_next.shape[1] == self.q.action_space.n
-        Q_sa_next = self.temperature * logsumexp(Q_s_next / self.temperature, axis=-1)
+        temperature = target_params['temperature']
+        Q_sa_next = temperature * logsumexp(Q_s_next / temperature, axis=-1)
         assert Q_sa_next.ndim == 1
 
         f, f_inv = self.q.value_transform.transform_func, self.q_targ.value_transform.inverse_func
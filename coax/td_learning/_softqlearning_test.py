@@ -50,6 +50,21 @@ class TestSoftQLearning(TestCase):
         self.assertPytreeNotEqual(params, q.params)
         self.assertPytreeNotEqual(function_state, q.function_state)
 
+    def test_temperature(self):
+        q = Q(self.func_q_type2, self.env_discrete, random_seed=11)
+        updater = SoftQLearning(q, optimizer=sgd(1.0), temperature=1.0)
+        transition_batch = get_transition_batch(self.env_discrete, batch_size=8, random_seed=42)
+        td_error = updater.td_error(transition_batch)
+
+        # the temperature is passed to the jitted function rather than baked into it
+        updater.temperature = 0.1
+        self.assertArrayNotEqual(updater.td_error(transition_batch), td_error)
+        updater.temperature = 1.0
+        self.assertArrayAlmostEqual(updater.td_error(transition_batch), td_error)
+
+        # the target_params are still cached for as long as nothing changes
+        self.assertIs(updater.target_params, updater.target_params)
+
     def test_update_boxspace(self):
         env = self.env_boxspace
         func_q = self.func_q_type1
@@ -50,6 +50,7 @@ Object Reference
     coax.utils.load
     coax.utils.loads
     coax.utils.merge_dicts
+    coax.utils.pmap
     coax.utils.pretty_print
     coax.utils.pretty_repr
     coax.utils.quantiles
@@ -94,7 +95,7 @@ from ._array import (
     tree_ravel,
     unvectorize,
 )
-from ._jit import jit
+from ._jit import jit, pmap
 from ._misc import (
     docstring,
     dump,
@@ -160,6 +161,7 @@ __all__ = (
     'load',
     'loads',
     'merge_dicts',
+    'pmap',
     'pretty_print',
     'pretty_repr',
     'quantiles',
@@ -506,7 +506,7 @@ def double_relu(arr):
 
 
 def _get_leaf_diagnostics(leaf, key_prefix):
-    # update this to add more grads diagnostics
+    # update this to add more grads diagnostics (and the global ones in get_grads_diagnostics)
     return {
         f'{key_prefix}max': jnp.max(jnp.abs(leaf)),
         f'{key_prefix}norm': jnp.linalg.norm(jnp.ravel(leaf)),
@@ -547,7 +547,16 @@ def get_grads_diagnostics(grads, key_prefix='', keep_tree_structure=False):
     """
     if keep_tree_structure:
         return jax.tree_map(lambda g: _get_leaf_diagnostics(g, key_prefix), grads)
-    return _get_leaf_diagnostics(tree_ravel(grads), key_prefix)
+
+    # reduce each leaf separately rather than on tree_ravel(grads), which would first copy all
+    # grads into one long flat array
+    leaves = jax.tree_util.tree_leaves(grads)
+    if not leaves:
+        return {f'{key_prefix}max': jnp.zeros(()), f'{key_prefix}norm': jnp.zeros(())}
+    return {
+        f'{key_prefix}max': jnp.max(jnp.stack([jnp.max(jnp.abs(g)) for g in leaves])),
+        f'{key_prefix}norm': jnp.sqrt(sum(jnp.sum(jnp.square(g)) for g in leaves)),
+    }
 
 
 def get_magnitude_quantiles(pytree, key_prefix=''):
@@ -11,7 +11,9 @@ from ._array import (
     check_preprocessors,
     chunks_pow2,
     default_preprocessor,
+    get_grads_diagnostics,
     get_transition_batch,
+    tree_ravel,
     tree_sample,
 )
 
@@ -118,3 +120,23 @@ class TestArrayUtils(TestCase):
         msg = r"Cannot take a larger sample than population when 'replace=False'"
         with self.assertRaisesRegex(ValueError, msg):
             tree_sample(tn, next(rngs), n=7, replace=False)
+
+    def test_get_grads_diagnostics(self):
+        rngs = PRNGSequence(13)
+        grads = {
+            'a': jax.random.normal(next(rngs), shape=(3, 5)),
+            'b': {'c': jax.random.normal(next(rngs), shape=(7,))},
+        }
+        flat = tree_ravel(grads)
+
+        diagnostics = get_grads_diagnostics(grads, key_prefix='foo/')
+        self.assertEqual(set(diagnostics), {'foo/max', 'foo/norm'})
+        self.assertAlmostEqual(diagnostics['foo/max'], jnp.max(jnp.abs(flat)))
+        self.assertAlmostEqual(diagnostics['foo/norm'], jnp.linalg.norm(flat))
+
+        diagnostics = get_grads_diagnostics(grads, key_prefix='foo/', keep_tree_structure=True)
+        self.assertAlmostEqual(diagnostics['b']['c']['foo/norm'], jnp.linalg.norm(grads['b']['c']))
+
+        # e.g. a function without any params has empty grads
+        diagnostics = get_grads_diagnostics({}, key_prefix='foo/')
+        self.assertEqual(diagnostics, {'foo/max': 0., 'foo/norm': 0.})
@@ -6,7 +6,9 @@ import jax
 
 __all__ = (
     'JittedFunc',
+    'PMappedFunc',
     'jit',
+    'pmap',
 )
 
 
@@ -58,6 +60,15 @@ class JittedFunc:
     def __call__(self, *args, **kwargs):
         return self._jitted_func(*args, **kwargs)
 
+    def lower(self, *args, **kwargs):
+        r"""
+
+        Lower the function for the given arguments, see :func:`jax.jit`. Calling
+        :code:`.compile()` on the result compiles the function ahead of time.
+
+        """
+        return self._jitted_func.lower(*args, **kwargs)
+
     @property
     def __signature__(self):
         return signature(self.func)
@@ -77,3 +88,69 @@ class JittedFunc:
             self.func,
             static_argnums=self.static_argnums,
             donate_argnums=self.donate_argnums)
+
+
+def pmap(func, axis_name=None, in_axes=0, out_axes=0, static_broadcasted_argnums=()):
+    r"""
+
+    An alternative of :func:`jax.pmap` that returns a picklable function, analogous to :func:`jit`.
+
+    Check out the original :func:`jax.pmap` docs for a more detailed description of the arguments.
+
+    Returns
+    -------
+    pmapped_func : PMappedFunc
+
+        A picklable function that is parallelized over the local devices.
+
+    """
+    return PMappedFunc(func, axis_name, in_axes, out_axes, static_broadcasted_argnums)
+
+
+class PMappedFunc:
+    __slots__ = (
+        'func', 'axis_name', 'in_axes', 'out_axes', 'static_broadcasted_argnums', '_pmapped_func')
+
+    def __init__(self, func, axis_name=None, in_axes=0, out_axes=0, static_broadcasted_argnums=()):
+        self.func = func
+        self.axis_name = axis_name
+        self.in_axes = in_axes
+        self.out_axes = out_axes
+        self.static_broadcasted_argnums = static_broadcasted_argnums
+        self._init_pmapped_func()
+
+    def __call__(self, *args, **kwargs):
+        return self._pmapped_func(*args, **kwargs)
+
+    def lower(self, *args, **kwargs):
+        r"""
+
+        Lower the function for the given arguments, see :func:`jax.pmap`. Calling
+        :code:`.compile()` on the result compiles the function ahead of time.
+
+        """
+        return self._pmapped_func.lower(*args, **kwargs)
+
+    @property
+    def __signature__(self):
+        return signature(self.func)
+
+    def __repr__(self):
+        return self.__class__.__name__ + str(self.__signature__)
+
+    def __getstate__(self):
+        return (
+            self.func, self.axis_name, self.in_axes, self.out_axes, self.static_broadcasted_argnums)
+
+    def __setstate__(self, state):
+        (self.func, self.axis_name, self.in_axes, self.out_axes,
+         self.static_broadcasted_argnums) = state
+        self._init_pmapped_func()
+
+    def _init_pmapped_func(self):
+        self._pmapped_func = jax.pmap(
+            self.func,
+            axis_name=self.axis_name,
+            in_axes=self.in_axes,
+            out_axes=self.out_axes,
+            static_broadcasted_argnums=self.static_broadcasted_argnums)